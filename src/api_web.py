@@ -1,29 +1,53 @@
 # API Web for extracting data from documents using Mistral LLM
 # Uses FastAPI to handle HTTP requests
 
-import json
+import copy
+import os
+import shutil
 import tempfile
 from pathlib import Path
 
-from fastapi import FastAPI, File, Form, UploadFile
+from fastapi import BackgroundTasks, FastAPI, File, Form, UploadFile
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import JSONResponse
 from dotenv import load_dotenv
 
-from src.core.config import DOC_TEMPLATES
+from src.core.config import DOC_TEMPLATES, load_template
 from src.core.utils import (
     build_prompt_content,
-    collect_fields,
+    fill_template,
     flatten_pages,
+    json_loads,
+    load_field_specs,
     set_path,
 )
 from src.services.mistral import call_mistral, load_pages
 
 load_dotenv(dotenv_path=Path(".env"), override=True)
 
+# Server-side only: clients must not choose where the server writes files (empty disables the cache)
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", ".llm_cache") or None
+
 app = FastAPI(title="Extraction 70 champs", version="1.0.0")
 
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+@app.on_event("startup")
+def preload_templates():
+    # Parse every built-in template once at startup (fails early if one is missing)
+    for doc_type, path in DOC_TEMPLATES.items():
+        load_template(doc_type)
+        load_field_specs(path)
+
+def remove_file(path):
+    try:
+        path.unlink()
+    except Exception:
+        pass
+
 @app.post("/extract")
 async def extract(
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     doc_type: str = Form("carnet"),
     template_path: str = Form(""),
@@ -32,57 +56,61 @@ async def extract(
     max_pages: int = Form(12),
     ocr_all: bool = Form(False),
 ):
-    # Save uploaded file temporarily to process it
+    # Stream uploaded file to a temporary file in 1 MB chunks, without loading it fully in memory
     suffix = Path(file.filename).suffix or ".bin"
-    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-        tmp.write(await file.read())
-        doc_path = Path(tmp.name)
+    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=suffix)
+    doc_path = Path(tmp.name)
+    # Remove the temporary file once the response has been sent (registered before
+    # streaming, so an interrupted upload is cleaned up too)
+    background_tasks.add_task(remove_file, doc_path)
 
     try:
-        # Load the appropriate JSON template based on document type
-        selected_template = template_path or DOC_TEMPLATES.get(doc_type, DOC_TEMPLATES.get("carnet"))
-        template_file = Path(selected_template)
-        if not template_file.exists():
-            return JSONResponse(status_code=400, content={"error": "template not found"})
+        with tmp:
+            await run_in_threadpool(shutil.copyfileobj, file.file, tmp, UPLOAD_CHUNK_SIZE)
 
-        template = template_file.read_text(encoding="utf-8")
-        template_obj = json.loads(template)
+        # Load the appropriate JSON template based on document type
+        # (built-in templates are preloaded, a custom template_path is read on each request)
+        if template_path:
+            template_file = Path(template_path)
+            if not template_file.exists():
+                return JSONResponse(status_code=400, content={"error": "template not found"})
+            template_obj = json_loads(template_file.read_bytes())
+        else:
+            doc_key = doc_type if doc_type in DOC_TEMPLATES else "carnet"
+            template_file = Path(DOC_TEMPLATES[doc_key])
+            template_obj = copy.deepcopy(load_template(doc_key))
 
-        # Load document pages, performing OCR if necessary (e.g. for scanned PDFs or images)
-        pages = load_pages(
+        # Load document pages, performing OCR if necessary (e.g. for scanned PDFs or images).
+        # Blocking calls (OCR, LLM, and their retry backoff) run in the threadpool to keep the event loop free
+        pages = await run_in_threadpool(
+            load_pages,
             doc_path,
             max_pages=max_pages,
             ocr_model=ocr_model,
             ocr_all=ocr_all,
         )
         doc_text = flatten_pages(pages)
-        field_specs = collect_fields(template_obj)
+        field_specs = load_field_specs(template_file)
         
         # Prepare the prompt for the LLM using document text and expected fields
         system, user = build_prompt_content(doc_text, field_specs)
         messages = [{"role": "system", "content": system}, {"role": "user", "content": user}]
         
         # Call Mistral API to extract data
-        llm_result = call_mistral(messages, model=model)
+        llm_result = await run_in_threadpool(call_mistral, messages, model=model, cache_dir=LLM_CACHE_DIR)
 
         # Fill metadata
         set_path(template_obj, "meta.file_type", suffix.lstrip("."), None, "")
         set_path(template_obj, "meta.file_name", Path(file.filename).name, None, "")
 
         # Populate the template with extracted values
-        for path, _, _ in field_specs:
-            payload = llm_result.get(path, {})
-            value = payload.get("value", "not found") if isinstance(payload, dict) else "not found"
-            page = payload.get("page") if isinstance(payload, dict) else None
-            excerpt = payload.get("excerpt") if isinstance(payload, dict) else ""
-            set_path(template_obj, path, value, page, excerpt)
+        fill_template(template_obj, field_specs, llm_result)
 
         return {"result": template_obj}
-    finally:
-        try:
-            doc_path.unlink()
-        except Exception:
-            pass
+    except BaseException:
+        # Background tasks do not run when the request fails: clean up right away
+        remove_file(doc_path)
+        raise
 
 @app.get("/health")
 def health():
@@ -2,31 +2,27 @@
 # Supports parallel processing and 2-pass extraction strategy
 
 import argparse
-import json
+import asyncio
 import os
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
 from dotenv import load_dotenv
 
-try:
-    from google import genai
-except ImportError:
-    print("Missing dependency. Install with: pip install google-genai")
-    exit(1)
-
 from src.core.config import DOC_TEMPLATES
+from src.core.ratelimit import TokenBucket
 from src.core.utils import (
-    build_prompt_content,
     collect_fields,
-    find_relevant_pages,
+    fill_template,
     flatten_pages,
+    group_fields_by_pages,
     is_found,
+    json_dumps,
+    json_loads,
     merge_extractions,
     set_path,
 )
-from src.services.gemini import call_gemini, load_pages, select_model
+from src.services.gemini import build_contents, call_gemini_async, load_pages, select_model
 
 def main():
     start_time = time.time()
@@ -45,12 +41,25 @@ def main():
     parser.add_argument("--vision-model", default="", help="Modèle vision/OCR (optionnel)")
     parser.add_argument("--max-pages", type=int, default=12, help="Nb max de pages PDF")
     parser.add_argument("--ocr-all", action="store_true", help="Forcer l'OCR sur toutes les pages")
+    parser.add_argument("--ocr-resolution", type=int, default=200, help="Résolution (DPI) du rendu des pages pour l'OCR")
+    parser.add_argument("--ocr-image-format", default="JPEG", choices=["JPEG", "PNG"], help="Format d'image envoyé à l'OCR (PNG pour les plans/schémas)")
+    parser.add_argument("--ocr-batch-size", type=int, default=4, help="Nb de pages envoyées par requête OCR (1 pour désactiver le regroupement)")
     parser.add_argument("--ocr-cache-dir", default=".ocr_cache", help="Dossier cache OCR (vide pour désactiver)")
+    parser.add_argument("--llm-cache-dir", default=".llm_cache", help="Dossier cache des réponses LLM (vide pour désactiver)")
     parser.add_argument("--chunk-pages", type=int, default=8, help="Nb de pages par chunk")
-    parser.add_argument("--parallel-api", type=int, default=2, help="Nombre d'appels API en parallèle")
+    parser.add_argument("--parallel-api", type=int, default=2, help="Nombre d'appels API en parallèle (LLM et OCR)")
+    parser.add_argument("--rpm", type=int, default=0, help="Limite de requêtes LLM par minute (0 = illimité)")
+    parser.add_argument("--tpm", type=int, default=0, help="Limite de tokens LLM par minute (0 = illimité)")
     parser.add_argument("--second-pass", action="store_true", help="Seconde passe ciblée sur champs manquants")
     args = parser.parse_args()
 
+    # Imported after argument parsing: google-genai is heavy to load
+    try:
+        from google import genai
+    except ImportError:
+        print("Missing dependency. Install with: pip install google-genai")
+        exit(1)
+
     client = genai.Client(api_key=api_key)
 
     # Select appropriate models (default to Pro versions for better reasoning)
@@ -72,8 +81,8 @@ def main():
         else template_file.with_name(template_file.stem + "_fill.json")
     )
 
-    template_obj = json.loads(template_file.read_text(encoding="utf-8"))
-    field_specs = collect_fields(template_obj)
+    template_obj = json_loads(template_file.read_bytes())
+    field_specs = tuple(collect_fields(template_obj))
 
     # Load pages with OCR support (caching enabled if configured)
     doc_path = Path(args.document)
@@ -83,58 +92,67 @@ def main():
         client=client,
         vision_model=vision_model,
         ocr_all=args.ocr_all,
+        resolution=args.ocr_resolution,
+        image_format=args.ocr_image_format,
+        ocr_batch_size=args.ocr_batch_size,
+        ocr_workers=max(1, args.parallel_api or 1),
         ocr_cache_dir=(args.ocr_cache_dir or None),
     )
     
-    # Pass 1: Split document into chunks and process in parallel
-    # This helps with long documents and avoids context window limits
-    llm_result = {}
-    chunk_pages = max(1, int(args.chunk_pages))
-    chunks = [pages[i:i + chunk_pages] for i in range(0, len(pages), chunk_pages)]
-
-    def run_chunk(chunk):
-        doc_text = flatten_pages(chunk)
-        system, user = build_prompt_content(doc_text, field_specs)
-        prompt = system + "\n\n" + user
-        return call_gemini(client, prompt, model=text_model)
-
-    if args.parallel_api and args.parallel_api > 1 and len(chunks) > 1:
-        with ThreadPoolExecutor(max_workers=args.parallel_api) as executor:
-            futures = [executor.submit(run_chunk, chunk) for chunk in chunks]
-            for future in as_completed(futures):
-                llm_result = merge_extractions(llm_result, future.result())
-    else:
-        for chunk in chunks:
-            llm_result = merge_extractions(llm_result, run_chunk(chunk))
-
-    # Pass 2: Target missing fields by looking at relevant pages only
-    # Searches for keywords related to missing fields to focus the LLM
-    if args.second_pass:
-        missing = []
-        for path, label, typ in field_specs:
-            val = llm_result.get(path, {}).get("value") if isinstance(llm_result.get(path), dict) else None
-            if not is_found(val):
-                missing.append((path, label, typ))
-
-        if missing:
-            relevant = find_relevant_pages(pages, missing)
-            if relevant:
-                doc_text = flatten_pages(relevant)
-                system, user = build_prompt_content(doc_text, missing)
-                prompt = system + "\n\n" + user
-                llm_result = merge_extractions(llm_result, call_gemini(client, prompt, model=text_model))
+    llm_cache_dir = args.llm_cache_dir or None
+    limiter = TokenBucket(args.rpm, args.tpm) if (args.rpm or args.tpm) else None
+    parallel_api = max(1, args.parallel_api or 1)
+
+    async def run_passes():
+        # Both passes share one event loop: calls go through the SDK's async client,
+        # with at most --parallel-api in flight
+        semaphore = asyncio.Semaphore(parallel_api)
+
+        async def run_one(prompt):
+            async with semaphore:
+                return await call_gemini_async(client, prompt, model=text_model, cache_dir=llm_cache_dir, limiter=limiter)
+
+        async def run_prompts(prompts):
+            return await asyncio.gather(*(run_one(prompt) for prompt in prompts))
+
+        # Pass 1: Split document into chunks and process in parallel
+        # This helps with long documents and avoids context window limits
+        llm_result = {}
+        chunk_pages = max(1, int(args.chunk_pages))
+        chunks = [pages[i:i + chunk_pages] for i in range(0, len(pages), chunk_pages)]
+
+        for result in await run_prompts([build_contents(flatten_pages(chunk), field_specs) for chunk in chunks]):
+            llm_result = merge_extractions(llm_result, result)
+
+        # Pass 2: Target missing fields by looking at relevant pages only
+        # Searches for keywords related to missing fields to focus the LLM
+        if args.second_pass:
+            missing = []
+            for path, label, typ in field_specs:
+                val = llm_result.get(path, {}).get("value") if isinstance(llm_result.get(path), dict) else None
+                if not is_found(val):
+                    missing.append((path, label, typ))
+
+            if missing:
+                # One small call per group of fields sharing relevant pages, instead of one
+                # prompt with every missing field; fields matching no page get a global call
+                clusters, unmatched = group_fields_by_pages(pages, missing)
+                prompts = [build_contents(flatten_pages(cluster_pages), fields) for fields, cluster_pages in clusters]
+                if unmatched:
+                    prompts.append(build_contents(flatten_pages(pages), unmatched))
+                for result in await run_prompts(prompts):
+                    llm_result = merge_extractions(llm_result, result)
+
+        return llm_result
+
+    llm_result = asyncio.run(run_passes())
 
     set_path(template_obj, "meta.file_type", doc_path.suffix.lstrip("."), None, "")
     set_path(template_obj, "meta.file_name", doc_path.name, None, "")
 
-    for path, _, _ in field_specs:
-        payload = llm_result.get(path, {})
-        value = payload.get("value", "not found") if isinstance(payload, dict) else "not found"
-        page = payload.get("page") if isinstance(payload, dict) else None
-        excerpt = payload.get("excerpt") if isinstance(payload, dict) else ""
-        set_path(template_obj, path, value, page, excerpt)
+    fill_template(template_obj, field_specs, llm_result)
 
-    output_path.write_text(json.dumps(template_obj, ensure_ascii=False, indent=2), encoding="utf-8")
+    output_path.write_text(json_dumps(template_obj, indent=True), encoding="utf-8")
     print(f"Écrit : {output_path}")
     elapsed = time.time() - start_time
     print(f"Temps d'execution: {elapsed:.2f}s")
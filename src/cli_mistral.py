@@ -2,20 +2,26 @@
 # Handles command line arguments for document processing
 
 import argparse
-import json
+import asyncio
 import os
 from pathlib import Path
 
+import httpx
 from dotenv import load_dotenv
 
 from src.core.config import DOC_TEMPLATES
+from src.core.ratelimit import TokenBucket
 from src.core.utils import (
     build_prompt_content,
     collect_fields,
+    fill_template,
     flatten_pages,
+    json_dumps,
+    json_loads,
+    merge_extractions,
     set_path,
 )
-from src.services.mistral import call_mistral, load_pages
+from src.services.mistral import call_mistral_async, load_pages
 
 def main():
     load_dotenv(dotenv_path=Path(".env"), override=True)
@@ -27,6 +33,14 @@ def main():
     parser.add_argument("--ocr-model", default="pixtral-large-latest", help="Modèle vision/OCR")
     parser.add_argument("--max-pages", type=int, default=12, help="Nb max de pages PDF")
     parser.add_argument("--ocr-all", action="store_true", help="Forcer l'OCR sur toutes les pages")
+    parser.add_argument("--ocr-resolution", type=int, default=200, help="Résolution (DPI) du rendu des pages pour l'OCR")
+    parser.add_argument("--ocr-image-format", default="JPEG", choices=["JPEG", "PNG"], help="Format d'image envoyé à l'OCR (PNG pour les plans/schémas)")
+    parser.add_argument("--ocr-batch-size", type=int, default=4, help="Nb de pages envoyées par requête OCR (1 pour désactiver le regroupement)")
+    parser.add_argument("--llm-cache-dir", default=".llm_cache", help="Dossier cache des réponses LLM (vide pour désactiver)")
+    parser.add_argument("--chunk-pages", type=int, default=8, help="Nb de pages par chunk")
+    parser.add_argument("--parallel-api", type=int, default=2, help="Nombre d'appels API en parallèle (LLM et OCR)")
+    parser.add_argument("--rpm", type=int, default=0, help="Limite de requêtes LLM par minute (0 = illimité)")
+    parser.add_argument("--tpm", type=int, default=0, help="Limite de tokens LLM par minute (0 = illimité)")
     args = parser.parse_args()
 
     # Load the extraction template
@@ -41,8 +55,8 @@ def main():
         else template_file.with_name(template_file.stem + "_fill.json")
     )
 
-    template_obj = json.loads(template_file.read_text(encoding="utf-8"))
-    field_specs = collect_fields(template_obj)
+    template_obj = json_loads(template_file.read_bytes())
+    field_specs = tuple(collect_fields(template_obj))
 
     # Load and process document pages (with optional OCR)
     doc_path = Path(args.document)
@@ -51,27 +65,44 @@ def main():
         max_pages=args.max_pages,
         ocr_model=args.ocr_model,
         ocr_all=args.ocr_all,
+        resolution=args.ocr_resolution,
+        image_format=args.ocr_image_format,
+        ocr_batch_size=args.ocr_batch_size,
+        ocr_workers=max(1, args.parallel_api or 1),
     )
-    doc_text = flatten_pages(pages)
-    
-    # Build prompt and call Mistral API
-    system, user = build_prompt_content(doc_text, field_specs)
-    messages = [{"role": "system", "content": system}, {"role": "user", "content": user}]
-    
-    llm_result = call_mistral(messages, model=args.model)
+
+    # Split document into chunks and process them concurrently (same strategy as the Gemini CLI).
+    # Requests share one HTTP/2 client; the semaphore bounds in-flight calls to --parallel-api.
+    llm_cache_dir = args.llm_cache_dir or None
+    limiter = TokenBucket(args.rpm, args.tpm) if (args.rpm or args.tpm) else None
+    parallel_api = max(1, args.parallel_api or 1)
+    chunk_pages = max(1, int(args.chunk_pages))
+    chunks = [pages[i:i + chunk_pages] for i in range(0, len(pages), chunk_pages)]
+
+    async def run_chunks():
+        semaphore = asyncio.Semaphore(parallel_api)
+        limits = httpx.Limits(max_connections=parallel_api)
+        async with httpx.AsyncClient(http2=True, limits=limits) as http:
+            async def run_chunk(chunk):
+                doc_text = flatten_pages(chunk)
+                system, user = build_prompt_content(doc_text, field_specs)
+                messages = [{"role": "system", "content": system}, {"role": "user", "content": user}]
+                async with semaphore:
+                    return await call_mistral_async(http, messages, model=args.model, cache_dir=llm_cache_dir, limiter=limiter)
+
+            return await asyncio.gather(*(run_chunk(chunk) for chunk in chunks))
+
+    llm_result = {}
+    for result in asyncio.run(run_chunks()):
+        llm_result = merge_extractions(llm_result, result)
 
     # Fill metadata
     set_path(template_obj, "meta.file_type", doc_path.suffix.lstrip("."), None, "")
     set_path(template_obj, "meta.file_name", doc_path.name, None, "")
 
-    for path, _, _ in field_specs:
-        payload = llm_result.get(path, {})
-        value = payload.get("value", "not found") if isinstance(payload, dict) else "not found"
-        page = payload.get("page") if isinstance(payload, dict) else None
-        excerpt = payload.get("excerpt") if isinstance(payload, dict) else ""
-        set_path(template_obj, path, value, page, excerpt)
+    fill_template(template_obj, field_specs, llm_result)
 
-    output_path.write_text(json.dumps(template_obj, ensure_ascii=False, indent=2), encoding="utf-8")
+    output_path.write_text(json_dumps(template_obj, indent=True), encoding="utf-8")
     print(f"Écrit : {output_path}")
 
 if __name__ == "__main__":
@@ -1,6 +1,9 @@
 import os
+from functools import lru_cache
 from pathlib import Path
 
+from src.core.utils import json_loads
+
 # Base directory relative to this file
 # This file is in src/core/config.py, so parent.parent is src/
 SRC_DIR = Path(__file__).resolve().parent.parent
@@ -18,6 +21,11 @@ DOC_TEMPLATES = {
     "devis": get_template_path("devis_facture_travaux_empty.json"),
 }
 
+@lru_cache(maxsize=None)
+def load_template(doc_type):
+    # Parsed once per process: callers must deep-copy before filling it
+    return json_loads(Path(DOC_TEMPLATES[doc_type]).read_bytes())
+
 DEFAULT_MISTRAL_MODEL = "mistral-large-latest"
 DEFAULT_OCR_MODEL = "pixtral-large-latest"
 DEFAULT_MAX_PAGES = 12
@@ -0,0 +1,111 @@
+import asyncio
+import functools
+import random
+import threading
+import time
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+class TokenBucket:
+    """Client-side limiter for requests per minute (rpm) and tokens per minute (tpm).
+
+    A limit of 0 disables the corresponding bucket. Shared safely between threads.
+    """
+
+    def __init__(self, rpm=0, tpm=0):
+        self.rpm = rpm or 0
+        self.tpm = tpm or 0
+        self._requests = float(self.rpm)
+        self._tokens = float(self.tpm)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._last
+        self._last = now
+        if self.rpm:
+            self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60.0)
+        if self.tpm:
+            self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60.0)
+
+    def _try_acquire(self, tokens):
+        # Takes the budget and returns 0 if available, else returns the time to wait
+        with self._lock:
+            self._refill()
+            wait = 0.0
+            if self.rpm and self._requests < 1:
+                wait = max(wait, (1 - self._requests) * 60.0 / self.rpm)
+            if self.tpm and self._tokens < tokens:
+                wait = max(wait, (tokens - self._tokens) * 60.0 / self.tpm)
+            if wait == 0.0:
+                if self.rpm:
+                    self._requests -= 1
+                if self.tpm:
+                    self._tokens -= tokens
+            return wait
+
+    def _cap(self, estimated_tokens):
+        # A single request larger than the whole budget would never fit: cap it to a full bucket
+        return min(estimated_tokens, self.tpm) if self.tpm else 0
+
+    def acquire(self, estimated_tokens=0):
+        tokens = self._cap(estimated_tokens)
+        while True:
+            wait = self._try_acquire(tokens)
+            if wait == 0.0:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self, estimated_tokens=0):
+        tokens = self._cap(estimated_tokens)
+        while True:
+            wait = self._try_acquire(tokens)
+            if wait == 0.0:
+                return
+            await asyncio.sleep(wait)
+
+def estimate_tokens(text):
+    # Rough heuristic: ~4 characters per token
+    return len(text) // 4
+
+def status_code(exc):
+    response = getattr(exc, "response", None)
+    code = getattr(response, "status_code", None)
+    if code is None:
+        # google-genai errors expose the HTTP status as `code`
+        code = getattr(exc, "code", None)
+    return code
+
+def _backoff(n, max_delay):
+    return min(max_delay, 2 ** n + random.random())
+
+def retry(max_retries=4, max_delay=60):
+    """Retry on rate-limit / transient server errors with exponential backoff and jitter.
+
+    Works on both regular functions and coroutines.
+    """
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                for n in range(max_retries + 1):
+                    try:
+                        return await func(*args, **kwargs)
+                    except Exception as exc:
+                        if n == max_retries or status_code(exc) not in RETRY_STATUS:
+                            raise
+                        await asyncio.sleep(_backoff(n, max_delay))
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            for n in range(max_retries + 1):
+                try:
+                    return func(*args, **kwargs)
+                except Exception as exc:
+                    if n == max_retries or status_code(exc) not in RETRY_STATUS:
+                        raise
+                    time.sleep(_backoff(n, max_delay))
+        return wrapper
+    return decorator
@@ -1,40 +1,102 @@
+import hashlib
 import io
 import json
+import os
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import lru_cache
 from pathlib import Path
 
-import pdfplumber
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
 
-def page_to_png_bytes(page, resolution=200):
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def json_loads(data):
+    # Fast path for trusted JSON (templates). LLM output goes through stdlib json instead,
+    # since orjson turns integers beyond 64 bits into floats and rejects NaN/Infinity.
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data)
+
+def json_dumps(obj, indent=False):
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        try:
+            return orjson.dumps(obj, option=option).decode("utf-8")
+        except orjson.JSONEncodeError:
+            # Integers beyond 64 bits, lone surrogates...: stdlib json handles them
+            pass
+    text = json.dumps(obj, ensure_ascii=False, indent=2 if indent else None)
+    try:
+        text.encode("utf-8")
+    except UnicodeEncodeError:
+        # Lone surrogates cannot be written as UTF-8: keep them as \u escapes
+        text = json.dumps(obj, ensure_ascii=True, indent=2 if indent else None)
+    return text
+
+def page_to_image_bytes(page, fmt="JPEG", quality=85, resolution=200):
+    # JPEG is several times smaller than PNG on scans; keep PNG for line-art documents
     img = page.to_image(resolution=resolution).original
     buf = io.BytesIO()
-    img.save(buf, format="PNG")
+    if fmt.upper() in ("JPEG", "JPG"):
+        img.convert("RGB").save(buf, format="JPEG", quality=quality, optimize=True)
+    else:
+        # PNG keeps Pillow's default compression: optimize=True would use maximum zlib effort
+        img.save(buf, format=fmt)
     return buf.getvalue()
 
+def image_mime_type(image_bytes):
+    if image_bytes.startswith(b"\xff\xd8"):
+        return "image/jpeg"
+    return "image/png"
+
 def flatten_pages(pages, max_chars=32000):
+    # The budget counts the "\n" separators too, so the joined text never exceeds it
     chunks = []
     total = 0
     for page_no, text in pages:
         snippet = f"[page {page_no}]\n{text.strip()}\n"
-        total += len(snippet)
+        total += len(snippet) + (1 if chunks else 0)
         if total > max_chars:
             break
         chunks.append(snippet)
     return "\n".join(chunks)
 
 def collect_fields(obj, prefix=""):
+    # Iterative depth-first walk; children are pushed in reverse so fields keep template order
     fields = []
-    for k, v in obj.items():
-        path = f"{prefix}.{k}" if prefix else k
+    stack = [(f"{prefix}.{k}" if prefix else k, v) for k, v in reversed(obj.items())]
+    while stack:
+        path, v = stack.pop()
         if path.startswith("meta."):
             continue
         if isinstance(v, dict) and "expected_type" in v:
             fields.append((path, path, v.get("expected_type", "")))
         elif isinstance(v, dict):
-            fields.extend(collect_fields(v, path))
+            stack.extend((f"{path}.{k}", child) for k, child in reversed(v.items()))
     return fields
 
-def build_prompt_content(doc_text, field_specs):
+@lru_cache(maxsize=32)
+def _load_field_specs(path, mtime):
+    template_obj = json_loads(Path(path).read_bytes())
+    return tuple(collect_fields(template_obj))
+
+def load_field_specs(path):
+    # Templates are static per doc_type: flatten once, re-read only if the file changes
+    return _load_field_specs(str(path), os.path.getmtime(path))
+
+@lru_cache(maxsize=128)
+def _build_static_prompt(field_specs):
     fields = "\n".join(f"- {p} | {label} | {typ}" for p, label, typ in field_specs)
     system = "Tu es un assistant qui extrait des champs factuels depuis un document immobilier. Réponds UNIQUEMENT avec un objet JSON, sans texte avant ou après."
     user_lines = [
@@ -44,10 +106,19 @@ def build_prompt_content(doc_text, field_specs):
         "Si c'est une liste : renvoie un tableau JSON.",
         "Si c'est un boolean : true/false.",
         "Si c'est un objet contact : {\"email\": \"...\", \"telephone\": \"...\"}.",
-        f"Champs à extraire :\n{fields}\n\nDocument paginé :\n{doc_text}",
+        f"Champs à extraire :\n{fields}\n\nDocument paginé :\n",
     ]
-    user = "\n".join(user_lines)
-    return system, user
+    return system, "\n".join(user_lines)
+
+def build_static_prompt(field_specs):
+    # Everything that does not depend on the document, so it is a byte-identical
+    # prefix across chunks and runs (lets providers reuse their prompt cache).
+    # Rendered once per field list, then only the document part changes per chunk.
+    return _build_static_prompt(tuple(field_specs))
+
+def build_prompt_content(doc_text, field_specs):
+    system, user_prefix = build_static_prompt(field_specs)
+    return system, user_prefix + doc_text
 
 def parse_json_content(content):
     try:
@@ -64,8 +135,41 @@ def parse_json_content(content):
             return {}
     return {}
 
+def llm_cache_path(cache_dir, model, payload):
+    if not cache_dir:
+        return None
+    key = json.dumps({"m": model, "p": payload}, sort_keys=True, ensure_ascii=False)
+    h = hashlib.sha256(key.encode("utf-8")).hexdigest()
+    return Path(cache_dir) / f"{h}.json"
+
+def read_llm_cache(cache_dir, model, payload):
+    path = llm_cache_path(cache_dir, model, payload)
+    if not path or not path.exists():
+        return None
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except Exception:
+        return None
+
+def write_llm_cache(cache_dir, model, payload, result):
+    path = llm_cache_path(cache_dir, model, payload)
+    if not path or not result:
+        return
+    try:
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        # Write to a per-thread temp file then rename, so concurrent chunk workers never see a partial file
+        tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_text(json_dumps(result), encoding="utf-8")
+        os.replace(tmp, path)
+    except Exception:
+        pass
+
+@lru_cache(maxsize=1024)
+def split_path(path):
+    return tuple(path.split("."))
+
 def set_path(root, path, value, page, excerpt):
-    parts = path.split(".")
+    parts = split_path(path)
     cursor = root
     for part in parts[:-1]:
         cursor = cursor.setdefault(part, {})
@@ -81,65 +185,204 @@ def set_path(root, path, value, page, excerpt):
     else:
         cursor[parts[-1]] = {"value": value, "source": {"page": page, "excerpt": excerpt}}
 
+def fill_template(template_obj, field_specs, llm_result):
+    for path, _, _ in field_specs:
+        payload = llm_result.get(path)
+        if isinstance(payload, dict):
+            set_path(template_obj, path, payload.get("value", "not found"), payload.get("page"), payload.get("excerpt"))
+        else:
+            set_path(template_obj, path, "not found", None, "")
+
+_NOT_FOUND = frozenset(("", "not found"))
+
 def is_found(value):
+    # Exact type checks: values come from json parsing, so there are no subclasses to handle
     if value is None:
         return False
-    if isinstance(value, str):
-        return value.strip().lower() not in ("", "not found")
-    if isinstance(value, list):
-        return len(value) > 0
-    if isinstance(value, dict):
-        return any(str(v).strip().lower() not in ("", "not found") for v in value.values())
+    t = type(value)
+    if t is str:
+        return value.strip().lower() not in _NOT_FOUND
+    if t is list:
+        return bool(value)
+    if t is dict:
+        return any(str(v).strip().lower() not in _NOT_FOUND for v in value.values())
     return True
 
 def merge_extractions(base, update):
-    if not isinstance(update, dict):
+    if type(update) is not dict:
         return base
     for key, val in update.items():
-        if not isinstance(val, dict):
-            continue
-        if is_found(val.get("value")):
+        if type(val) is dict and is_found(val.get("value")):
             base[key] = val
     return base
 
-def find_relevant_pages(pages, field_specs):
-    tokens = set()
-    for _, label, _ in field_specs:
-        for t in re.split(r"[^a-zA-Z0-9]+", label.lower()):
-            if len(t) > 3:
-                tokens.add(t)
-    selected = []
+def build_keyword_finder(tokens):
+    # Returns a callable giving the set of tokens contained in a lowercased text,
+    # scanning the text once (Aho-Corasick if available, else a single compiled regex)
+    if not tokens:
+        return lambda text: set()
+    if ahocorasick is not None:
+        automaton = ahocorasick.Automaton()
+        for t in tokens:
+            automaton.add_word(t, t)
+        automaton.make_automaton()
+        return lambda text: {t for _, t in automaton.iter(text)}
+    # The lookahead tries every position, longest token first; shorter tokens contained
+    # in a match are added back, so the result equals one substring test per token
+    ordered = sorted(tokens, key=len, reverse=True)
+    pattern = re.compile("(?=(" + "|".join(re.escape(t) for t in ordered) + "))")
+    contained = {t: {u for u in tokens if u in t} for t in tokens}
+
+    def find(text):
+        found = set()
+        for t in set(pattern.findall(text)):
+            found |= contained[t]
+        return found
+    return find
+
+def label_tokens(label):
+    return {t for t in re.split(r"[^a-zA-Z0-9]+", label.lower()) if len(t) > 3}
+
+# Keywords too generic to locate a field: shared by more than this many fields...
+MAX_KEYWORD_FIELDS = 2
+# ...or found on more than this share of the pages (documents of 4 pages or more)
+MAX_KEYWORD_PAGE_SHARE = 0.5
+
+def group_fields_by_pages(pages, field_specs):
+    # Clusters fields whose keyword-matching pages overlap (connected components),
+    # returning [(fields, cluster_pages)] plus the fields matching no page at all.
+    # Keywords come from the leaf key only (the section prefix is shared by every field)
+    # and generic ones are dropped, otherwise a single page links all clusters together.
+    field_tokens = [label_tokens(label.rsplit(".", 1)[-1]) for _, label, _ in field_specs]
+    token_fields = {}
+    for i, tokens in enumerate(field_tokens):
+        for t in tokens:
+            token_fields.setdefault(t, []).append(i)
+    find = build_keyword_finder({t for t, idxs in token_fields.items() if len(idxs) <= MAX_KEYWORD_FIELDS})
+
+    # Single scan of each page for all keywords
+    token_pages = {}
     for page_no, text in pages:
-        low = text.lower()
-        if any(t in low for t in tokens):
-            selected.append((page_no, text))
-    return selected
+        for t in find(text.lower()):
+            token_pages.setdefault(t, set()).add(page_no)
+    if len(pages) >= 4:
+        max_pages = MAX_KEYWORD_PAGE_SHARE * len(pages)
+        token_pages = {t: page_nos for t, page_nos in token_pages.items() if len(page_nos) <= max_pages}
 
-def load_pages_with_ocr(path, max_pages, ocr_callback, ocr_all=False):
+    field_pages = [set() for _ in field_specs]
+    for t, page_nos in token_pages.items():
+        for i in token_fields[t]:
+            field_pages[i] |= page_nos
+
+    clusters = []
+    unmatched = []
+    for i, page_nos in enumerate(field_pages):
+        if not page_nos:
+            unmatched.append(field_specs[i])
+            continue
+        merged = [c for c in clusters if c[1] & page_nos]
+        clusters = [c for c in clusters if not (c[1] & page_nos)]
+        # Field indices are sorted so merged clusters keep template order
+        idxs = sorted([j for c in merged for j in c[0]] + [i])
+        clusters.append((idxs, page_nos.union(*(c[1] for c in merged))))
+    clusters.sort(key=lambda c: c[0][0])
+    grouped = [
+        ([field_specs[j] for j in idxs], [(page_no, text) for page_no, text in pages if page_no in page_nos])
+        for idxs, page_nos in clusters
+    ]
+    return grouped, unmatched
+
+def ocr_batch_prompt(count):
+    return (
+        f"Transcris le texte lisible de chacune des {count} images, dans l'ordre. "
+        "Avant chaque transcription, écris seul sur une ligne ===PAGE i=== "
+        "(i = numéro de l'image, à partir de 1)."
+    )
+
+def split_ocr_pages(content, count):
+    # Returns one transcription per image, or None if the delimiters do not match
+    parts = re.split(r"^\s*===\s*PAGE\s+(\d+)\s*===\s*$", content or "", flags=re.MULTILINE)
+    texts = {}
+    for i in range(1, len(parts) - 1, 2):
+        texts[int(parts[i])] = parts[i + 1].strip()
+    if sorted(texts) != list(range(1, count + 1)):
+        return None
+    return [texts[i] for i in range(1, count + 1)]
+
+def load_pages_with_ocr(
+    path,
+    max_pages,
+    ocr_callback,
+    ocr_all=False,
+    resolution=200,
+    image_format="JPEG",
+    ocr_workers=2,
+    ocr_batch_callback=None,
+    ocr_batch_size=4,
+):
     pages = []
     path_obj = Path(path)
     suffix = path_obj.suffix.lower()
     
     if suffix == ".pdf":
-        with pdfplumber.open(path_obj) as pdf:
+        # Imported lazily: pdfplumber is slow to import and unused for image inputs
+        import pdfplumber
+
+        # Pages needing OCR are grouped in batches sent as a single multi-image request
+        # (one image per request without a batch callback)
+        if ocr_batch_callback is None:
+            ocr_batch_size = 1
+            ocr_batch_callback = lambda images: [ocr_callback(images[0])]
+        ocr_batch_size = max(1, ocr_batch_size)
+
+        # Rendering stays on this thread (pdfium is not thread-safe) while OCR calls,
+        # which are network-bound, run concurrently as soon as each batch is rendered
+        ocr_futures = []
+        pending = []
+        # Backpressure: at most this many rendered batches are in flight (queued or running),
+        # so a long scanned PDF does not keep every rendered image in memory
+        max_queued = 2 * max(1, ocr_workers)
+        with pdfplumber.open(path_obj) as pdf, ThreadPoolExecutor(max_workers=ocr_workers) as executor:
+            def submit_pending():
+                idxs = [idx for idx, _ in pending]
+                images = [image for _, image in pending]
+                ocr_futures.append((idxs, executor.submit(ocr_batch_callback, images)))
+                pending.clear()
+                in_flight = [future for _, future in ocr_futures if not future.done()]
+                if len(in_flight) > max_queued:
+                    wait(in_flight[:len(in_flight) - max_queued])
+
             for idx, page in enumerate(pdf.pages, start=1):
                 if max_pages and idx > max_pages:
                     break
-                text = (page.extract_text() or "").strip()
+                # page.chars is already parsed: pure scans have none, so skip the text layout pass
+                text = (page.extract_text() or "").strip() if page.chars else ""
                 needs_ocr = ocr_all or len(text) < 80
                 if needs_ocr:
                     try:
-                        png_bytes = page_to_png_bytes(page)
-                        ocr_text = ocr_callback(png_bytes)
-                        if ocr_text and ocr_text not in text:
-                            text = (text + "\n" + ocr_text).strip() if text else ocr_text
+                        pending.append((idx, page_to_image_bytes(page, fmt=image_format, resolution=resolution)))
                     except Exception:
                         pass
+                    if len(pending) >= ocr_batch_size:
+                        submit_pending()
                 pages.append((idx, text))
+            if pending:
+                submit_pending()
+
+        ocr_texts = {}
+        for idxs, future in ocr_futures:
+            try:
+                ocr_texts.update(zip(idxs, future.result()))
+            except Exception:
+                pass
+        for i, (idx, text) in enumerate(pages):
+            ocr_text = ocr_texts.get(idx)
+            if ocr_text and ocr_text not in text:
+                pages[i] = (idx, (text + "\n" + ocr_text).strip() if text else ocr_text)
     else:
         try:
-            png_bytes = path_obj.read_bytes()
-            ocr_text = ocr_callback(png_bytes)
+            image_bytes = path_obj.read_bytes()
+            ocr_text = ocr_callback(image_bytes)
             pages.append((1, ocr_text))
         except Exception:
             pages.append((1, ""))
@@ -7,21 +7,20 @@ import argparse
 import json
 from pathlib import Path
 
-import pandas as pd
-from openpyxl.styles import Alignment, PatternFill, Border, Side
 
 def collect_fields(obj, prefix=""):
-    """Recursively collect all fields that have a 'value' key."""
+    """Collect all fields that have a 'value' key, in document order."""
     fields = []
-    for k, v in obj.items():
-        path = f"{prefix}.{k}" if prefix else k
+    stack = [(f"{prefix}.{k}" if prefix else k, v) for k, v in reversed(obj.items())]
+    while stack:
+        path, v = stack.pop()
         if path.startswith("meta."):
             continue
         if isinstance(v, dict) and "value" in v:
             label = path.split(".")[-1].replace("_", " ")
             fields.append((path, label))
         elif isinstance(v, dict):
-            fields.extend(collect_fields(v, path))
+            stack.extend((f"{path}.{k}", child) for k, child in reversed(v.items()))
     return fields
 
 
@@ -54,7 +53,8 @@ def normalize_value(val):
     return str(val)
 
 
-def build_matrix(obj):
+def build_rows(obj):
+    """Build the 4 report rows: labels, values, pages and excerpts (one column per field)."""
     fields = collect_fields(obj)
     labels, values, pages, excerpts = [], [], [], []
     for path, label in fields:
@@ -63,14 +63,16 @@ def build_matrix(obj):
         values.append(normalize_value(val))
         pages.append("" if page is None else page)
         excerpts.append("" if excerpt is None else excerpt)
-    return pd.DataFrame([labels, values, pages, excerpts])
+    return [labels, values, pages, excerpts]
 
 
-def apply_styling(xlsx_path, df):
-    """Apply visual styling: alternating row colors, borders, and column widths."""
-    from openpyxl import load_workbook
+def write_styled_workbook(xlsx_path, rows):
+    """Write the rows with styling applied inline: alternating column colors, borders, and column widths."""
+    from openpyxl import Workbook
+    from openpyxl.styles import Alignment, PatternFill, Border, Side
+    from openpyxl.utils import get_column_letter
 
-    wb = load_workbook(xlsx_path)
+    wb = Workbook()
     ws = wb.active
 
     fill_a = PatternFill("solid", fgColor="E2EFDA")  # vert clair
@@ -79,22 +81,19 @@ def apply_styling(xlsx_path, df):
     thin = Side(style="thin", color="000000")
     border_all = Border(left=thin, right=thin, top=thin, bottom=thin)
 
-    max_col_widths = []
+    col_widths = {}
 
-    for col_idx in range(1, df.shape[1] + 1):
-        fill = fill_a if col_idx % 2 else fill_b
-        col_width = 0
-        for row_idx in range(1, 4 + 1):  # 4 lignes
-            cell = ws.cell(row=row_idx, column=col_idx)
-            cell.fill = fill
+    for row_idx, row in enumerate(rows, start=1):
+        for col_idx, value in enumerate(row, start=1):
+            cell = ws.cell(row=row_idx, column=col_idx, value=value)
+            cell.fill = fill_a if col_idx % 2 else fill_b
             cell.alignment = align
             cell.border = border_all
-            text = str(cell.value) if cell.value is not None else ""
-            col_width = max(col_width, len(text))
-        max_col_widths.append(min(col_width + 4, 80))
+            text = str(value) if value is not None else ""
+            col_widths[col_idx] = max(col_widths.get(col_idx, 0), len(text))
 
-    for col_idx, width in enumerate(max_col_widths, start=1):
-        ws.column_dimensions[ws.cell(row=1, column=col_idx).column_letter].width = width
+    for col_idx, width in col_widths.items():
+        ws.column_dimensions[get_column_letter(col_idx)].width = min(width + 4, 80)
 
     ws.row_dimensions[1].height = 30
     ws.row_dimensions[2].height = 30
@@ -122,10 +121,9 @@ def main():
     )
 
     data = json.loads(args.input_json.read_text(encoding="utf-8"))
-    df = build_matrix(data)
+    rows = build_rows(data)
     output.parent.mkdir(parents=True, exist_ok=True)
-    df.to_excel(output, index=False, header=False)
-    apply_styling(output, df)
+    write_styled_workbook(output, rows)
     print(f"Écrit : {output}")
 
 
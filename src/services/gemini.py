@@ -1,8 +1,19 @@
 import base64
 import hashlib
+import json
 from pathlib import Path
 
-from src.core.utils import parse_json_content, load_pages_with_ocr
+from src.core.ratelimit import estimate_tokens, retry
+from src.core.utils import (
+    build_static_prompt,
+    image_mime_type,
+    load_pages_with_ocr,
+    ocr_batch_prompt,
+    parse_json_content,
+    read_llm_cache,
+    split_ocr_pages,
+    write_llm_cache,
+)
 
 def select_model(client, prefer_pro=True):
     model_name = None
@@ -17,14 +28,14 @@ def select_model(client, prefer_pro=True):
             model_name = name
     return model_name
 
-def ocr_cache_path(cache_dir, png_bytes):
+def ocr_cache_path(cache_dir, image_bytes):
     if not cache_dir:
         return None
-    h = hashlib.sha256(png_bytes).hexdigest()
+    h = hashlib.sha256(image_bytes).hexdigest()
     return Path(cache_dir) / f"{h}.txt"
 
-def read_ocr_cache(cache_dir, png_bytes):
-    path = ocr_cache_path(cache_dir, png_bytes)
+def read_ocr_cache(cache_dir, image_bytes):
+    path = ocr_cache_path(cache_dir, image_bytes)
     if not path or not path.exists():
         return None
     try:
@@ -32,8 +43,8 @@ def read_ocr_cache(cache_dir, png_bytes):
     except Exception:
         return None
 
-def write_ocr_cache(cache_dir, png_bytes, text):
-    path = ocr_cache_path(cache_dir, png_bytes)
+def write_ocr_cache(cache_dir, image_bytes, text):
+    path = ocr_cache_path(cache_dir, image_bytes)
     if not path:
         return
     try:
@@ -42,34 +53,96 @@ def write_ocr_cache(cache_dir, png_bytes, text):
     except Exception:
         pass
 
-def gemini_ocr_image(client, png_bytes, vision_model, cache_dir=None):
-    cached = read_ocr_cache(cache_dir, png_bytes)
+def image_part(image_bytes):
+    b64 = base64.b64encode(image_bytes).decode("utf-8")
+    return {"inline_data": {"mime_type": image_mime_type(image_bytes), "data": b64}}
+
+@retry()
+def gemini_ocr_request(client, parts, vision_model):
+    resp = client.models.generate_content(model=vision_model, contents=[{"role": "user", "parts": parts}])
+    return getattr(resp, "text", "") or ""
+
+def gemini_ocr_image(client, image_bytes, vision_model, cache_dir=None):
+    cached = read_ocr_cache(cache_dir, image_bytes)
     if cached is not None:
         return cached
-    b64 = base64.b64encode(png_bytes).decode("utf-8")
-    contents = [
+    parts = [
+        {"text": "Transcris le texte lisible de cette image."},
+        image_part(image_bytes),
+    ]
+    text = gemini_ocr_request(client, parts, vision_model)
+    write_ocr_cache(cache_dir, image_bytes, text)
+    return text
+
+def gemini_ocr_images(client, images, vision_model, cache_dir=None):
+    # The cache stays per image: only cache misses are sent in the batched request
+    results = [read_ocr_cache(cache_dir, image_bytes) for image_bytes in images]
+    missing = [i for i, text in enumerate(results) if text is None]
+    if len(missing) == 1:
+        i = missing[0]
+        results[i] = gemini_ocr_image(client, images[i], vision_model, cache_dir=cache_dir)
+    elif missing:
+        parts = [{"text": ocr_batch_prompt(len(missing))}]
+        parts.extend(image_part(images[i]) for i in missing)
+        try:
+            texts = split_ocr_pages(gemini_ocr_request(client, parts, vision_model), len(missing))
+        except Exception:
+            texts = None
+        if texts is None:
+            # Batched request failed or delimiters not respected: fall back to one request
+            # per image (cached on success), so a failure only loses the pages that fail on their own
+            for i in missing:
+                try:
+                    results[i] = gemini_ocr_image(client, images[i], vision_model, cache_dir=cache_dir)
+                except Exception:
+                    results[i] = ""
+        else:
+            for i, text in zip(missing, texts):
+                write_ocr_cache(cache_dir, images[i], text)
+                results[i] = text
+    return results
+
+def build_contents(doc_text, field_specs):
+    # Static instructions and field list first, document last, as separate parts:
+    # the shared prefix is what Gemini's implicit prompt caching can reuse
+    system, user_prefix = build_static_prompt(field_specs)
+    return [
         {
             "role": "user",
             "parts": [
-                {"text": "Transcris le texte lisible de cette image."},
-                {"inline_data": {"mime_type": "image/png", "data": b64}},
+                {"text": system + "\n\n" + user_prefix},
+                {"text": doc_text},
             ],
         }
     ]
-    resp = client.models.generate_content(model=vision_model, contents=contents)
-    text = getattr(resp, "text", "") or ""
-    write_ocr_cache(cache_dir, png_bytes, text)
-    return text
 
-def call_gemini(client, prompt, model):
-    resp = client.models.generate_content(model=model, contents=prompt)
+def prompt_tokens(prompt):
+    prompt_text = prompt if isinstance(prompt, str) else json.dumps(prompt, ensure_ascii=False)
+    return estimate_tokens(prompt_text)
+
+@retry()
+async def call_gemini_async(client, prompt, model, cache_dir=None, limiter=None):
+    # Extraction call through the SDK's async client (client.aio)
+    cached = read_llm_cache(cache_dir, model, prompt)
+    if cached is not None:
+        return cached
+    if limiter:
+        await limiter.acquire_async(estimated_tokens=prompt_tokens(prompt))
+    resp = await client.aio.models.generate_content(model=model, contents=prompt)
     text = getattr(resp, "text", "") or ""
-    return parse_json_content(text)
+    parsed = parse_json_content(text)
+    write_llm_cache(cache_dir, model, prompt, parsed)
+    return parsed
 
-def load_pages(path, max_pages, client, vision_model, ocr_all, ocr_cache_dir=None):
+def load_pages(path, max_pages, client, vision_model, ocr_all, ocr_cache_dir=None, resolution=200, image_format="JPEG", ocr_batch_size=4, ocr_workers=2):
     return load_pages_with_ocr(
         path,
         max_pages,
-        lambda png: gemini_ocr_image(client, png, vision_model, cache_dir=ocr_cache_dir),
-        ocr_all=ocr_all
+        lambda image: gemini_ocr_image(client, image, vision_model, cache_dir=ocr_cache_dir),
+        ocr_all=ocr_all,
+        resolution=resolution,
+        image_format=image_format,
+        ocr_batch_callback=lambda images: gemini_ocr_images(client, images, vision_model, cache_dir=ocr_cache_dir),
+        ocr_batch_size=ocr_batch_size,
+        ocr_workers=ocr_workers,
     )
@@ -2,46 +2,114 @@ import base64
 import os
 import requests
 
-from src.core.utils import parse_json_content, load_pages_with_ocr
+from src.core.ratelimit import estimate_tokens, retry
+from src.core.utils import (
+    image_mime_type,
+    load_pages_with_ocr,
+    ocr_batch_prompt,
+    parse_json_content,
+    read_llm_cache,
+    split_ocr_pages,
+    write_llm_cache,
+)
 
-def mistral_ocr_image(png_bytes, ocr_model):
+@retry()
+def mistral_ocr_request(content, ocr_model):
     api_key = os.getenv("MISTRAL_API_KEY")
     if not api_key:
         raise EnvironmentError("MISTRAL_API_KEY manquant (charger .env)")
     url = "https://api.mistral.ai/v1/chat/completions"
-    b64 = base64.b64encode(png_bytes).decode("utf-8")
-    data_url = f"data:image/png;base64,{b64}"
-    messages = [
-        {
-            "role": "user",
-            "content": [
-                {"type": "text", "text": "Transcris le texte lisible de cette image."},
-                {"type": "image_url", "image_url": {"url": data_url}},
-            ],
-        }
-    ]
+    messages = [{"role": "user", "content": content}]
     payload = {"model": ocr_model, "messages": messages, "temperature": 0}
     headers = {"Authorization": f"Bearer {api_key}"}
     resp = requests.post(url, json=payload, headers=headers, timeout=120)
     resp.raise_for_status()
     return resp.json()["choices"][0]["message"]["content"] or ""
 
-def call_mistral(messages, model="mistral-large-latest"):
+def image_part(image_bytes):
+    b64 = base64.b64encode(image_bytes).decode("utf-8")
+    data_url = f"data:{image_mime_type(image_bytes)};base64,{b64}"
+    return {"type": "image_url", "image_url": {"url": data_url}}
+
+def mistral_ocr_image(image_bytes, ocr_model):
+    content = [
+        {"type": "text", "text": "Transcris le texte lisible de cette image."},
+        image_part(image_bytes),
+    ]
+    return mistral_ocr_request(content, ocr_model)
+
+def mistral_ocr_images(images, ocr_model):
+    if len(images) == 1:
+        return [mistral_ocr_image(images[0], ocr_model)]
+    content = [{"type": "text", "text": ocr_batch_prompt(len(images))}]
+    content.extend(image_part(image_bytes) for image_bytes in images)
+    try:
+        texts = split_ocr_pages(mistral_ocr_request(content, ocr_model), len(images))
+    except Exception:
+        texts = None
+    if texts is None:
+        # Batched request failed or delimiters not respected: fall back to one request
+        # per image, so a failure only loses the pages that fail on their own
+        texts = []
+        for image_bytes in images:
+            try:
+                texts.append(mistral_ocr_image(image_bytes, ocr_model))
+            except Exception:
+                texts.append("")
+    return texts
+
+def chat_request(messages, model):
     api_key = os.getenv("MISTRAL_API_KEY")
     if not api_key:
         raise EnvironmentError("MISTRAL_API_KEY manquant (charger .env)")
     url = "https://api.mistral.ai/v1/chat/completions"
     headers = {"Authorization": f"Bearer {api_key}"}
     payload = {"model": model, "messages": messages, "temperature": 0}
+    return url, payload, headers
+
+def messages_tokens(messages):
+    return sum(estimate_tokens(m["content"]) for m in messages)
+
+@retry()
+def call_mistral(messages, model="mistral-large-latest", cache_dir=None, limiter=None):
+    cached = read_llm_cache(cache_dir, model, messages)
+    if cached is not None:
+        return cached
+    url, payload, headers = chat_request(messages, model)
+    if limiter:
+        limiter.acquire(estimated_tokens=messages_tokens(messages))
     resp = requests.post(url, json=payload, headers=headers, timeout=180)
     resp.raise_for_status()
     content = resp.json()["choices"][0]["message"]["content"]
-    return parse_json_content(content)
+    parsed = parse_json_content(content)
+    write_llm_cache(cache_dir, model, messages, parsed)
+    return parsed
+
+@retry()
+async def call_mistral_async(client, messages, model="mistral-large-latest", cache_dir=None, limiter=None):
+    # Same as call_mistral over a shared httpx.AsyncClient (connection reuse, HTTP/2)
+    cached = read_llm_cache(cache_dir, model, messages)
+    if cached is not None:
+        return cached
+    url, payload, headers = chat_request(messages, model)
+    if limiter:
+        await limiter.acquire_async(estimated_tokens=messages_tokens(messages))
+    resp = await client.post(url, json=payload, headers=headers, timeout=180)
+    resp.raise_for_status()
+    content = resp.json()["choices"][0]["message"]["content"]
+    parsed = parse_json_content(content)
+    write_llm_cache(cache_dir, model, messages, parsed)
+    return parsed
 
-def load_pages(path, max_pages, ocr_model, ocr_all):
+def load_pages(path, max_pages, ocr_model, ocr_all, resolution=200, image_format="JPEG", ocr_batch_size=4, ocr_workers=2):
     return load_pages_with_ocr(
         path, 
         max_pages, 
-        lambda png: mistral_ocr_image(png, ocr_model),
-        ocr_all=ocr_all
+        lambda image: mistral_ocr_image(image, ocr_model),
+        ocr_all=ocr_all,
+        resolution=resolution,
+        image_format=image_format,
+        ocr_batch_callback=lambda images: mistral_ocr_images(images, ocr_model),
+        ocr_batch_size=ocr_batch_size,
+        ocr_workers=ocr_workers,
     )